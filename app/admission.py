@@ -0,0 +1,215 @@
+"""Admission control between the joblist and `docker run`
+
+Without admission control every job is started at its scheduled second, however contended the host already is, and
+algorithm 1 then has to squeeze the oversubscribed containers. The AdmissionController instead queues arrivals while
+the demand of the active containers would exceed the host's capacity, and admits them as containers become completing
+or exit.
+
+The demand of a container is its recent cpu usage in cores, or `default_demand` if there are no stats for it yet.
+Containers that algorithm 1 has marked as completing do not count. A queued job is admitted when its own
+`default_demand` fits in what is left of `overcommit * cpu_count()`, or unconditionally when nothing is running.
+
+Queued jobs are ordered by one of ORDERINGS:
+    fifo: by arrival
+    sef: shortest expected first, using the mean observed run time of earlier containers of the same image
+         (images that have not finished yet are assumed to take the mean of all observed run times)
+
+Each admitted job is appended to `<name>_admission.csv` with its queueing delay, and whether `docker run` started it
+or failed (e.g. for a missing image); a failed job is dropped rather than stopping the launcher. The queue is written
+to `<name>_admission.json` whenever it changes, together with the last second of the joblist whose jobs it holds, so
+jobs that were waiting when the controller crashed are still admitted after `--resume`.
+"""
+import os
+import csv
+import time
+import logging
+import subprocess
+from multiprocessing import cpu_count
+
+from app.listener import get_active_containers
+from app.checkpoint import write_checkpoint, read_checkpoint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+fh = logging.FileHandler('FlowCon.log')
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+ORDERINGS = ['fifo', 'sef']
+ADMISSION_COLUMNS = ('image', 'arrival', 'admitted', 'queueing_delay', 'container_id', 'status')
+
+
+class QueuedJob(object):
+    """A job from the joblist waiting to be admitted"""
+
+    __slots__ = ('image', 'arrival', 'seq')
+
+    def __init__(self, image, arrival, seq):
+        self.image = image
+        self.arrival = arrival
+        self.seq = seq
+
+
+class AdmissionController(object):
+
+    def __init__(self, trial, order='fifo', default_demand=1., overcommit=1., resume=False):
+        """Queue jobs from the joblist until the host has capacity for them
+
+        :param trial: the Trial whose ContainerList and ResourceMonitor are used to estimate demand
+        :param order: one of ORDERINGS
+        :param default_demand: assumed demand, in cores, of a job that has no stats yet
+        :param overcommit: the capacity is overcommit * cpu_count()
+        :param resume: if True, reload the queue saved by a previous controller for this Trial
+        """
+        if order not in ORDERINGS:
+            raise ValueError("Unknown admission order {}, expected one of {}".format(order, ORDERINGS))
+        self.trial = trial
+        self.order = order
+        self.default_demand = default_demand
+        self.capacity = overcommit * cpu_count()
+        self.queue = []
+        self.launched = {}   # short container id -> (image, launch time)
+        self.durations = {}  # image -> list of observed run times
+        self.submitted = -1  # the last second of the joblist whose jobs have been queued
+        self._seq = 0
+        self._fn = '{}_admission.csv'.format(trial.name)
+        self._state_fn = '{}_admission.json'.format(trial.name)
+        if not os.path.exists(self._fn):
+            with open(self._fn, 'w', newline='') as f:
+                csv.writer(f).writerow(ADMISSION_COLUMNS)
+        if resume and os.path.exists(self._state_fn):
+            self.restore(read_checkpoint(self._state_fn))
+
+    @property
+    def pending(self):
+        """Number of jobs waiting to be admitted"""
+        return len(self.queue)
+
+    def submit(self, images, second):
+        """Add the jobs that arrived at one second of the joblist to the queue, and save it
+
+        :param images: the images of the jobs
+        :param second: the second of the joblist they were scheduled at
+        :return: None
+        """
+        now = time.time()
+        for image in images:
+            self.queue.append(QueuedJob(image, now, self._seq))
+            self._seq += 1
+            logger.info("Queued {} ({} jobs waiting)".format(image, len(self.queue)))
+        self.submitted = second
+        self.save()
+
+    def admit(self):
+        """Launch as many queued jobs, in order, as the current demand allows
+
+        :return: the number of jobs launched
+        """
+        active = set(get_active_containers())
+        if self._record_exits(active):
+            self.save()
+        if not self.queue:
+            return 0
+
+        demand = self.demand(active)
+        self.queue.sort(key=self._priority)
+        admitted = 0
+        while self.queue:
+            if active and demand + self.default_demand > self.capacity:
+                logger.info("Demand {:.2f} of capacity {:.2f} in use, {} jobs waiting".format(
+                    demand, self.capacity, len(self.queue)))
+                break
+            job = self.queue.pop(0)
+            c_id = self._launch(job)
+            self.save()
+            if c_id is None:
+                continue
+            active.add(c_id)
+            demand += self.default_demand
+            admitted += 1
+        return admitted
+
+    def demand(self, active):
+        """Estimate the cores wanted by the running containers
+
+        :param active: a set of short IDs of the running containers
+        :return: float
+        """
+        since = time.time() - self.trial.interval
+        demand = 0.
+        for c_id in active:
+            c = self.trial.containers.get(c_id)
+            if c is not None and c.completing:
+                continue
+            cpu = self.trial.monitor.cpu_mean(c_id, since)
+            demand += self.default_demand if cpu is None else cpu * cpu_count()
+        return demand
+
+    def expected_duration(self, image):
+        """Mean observed run time of containers of `image`, or of all containers if none has finished yet"""
+        observed = self.durations.get(image)
+        if observed:
+            return sum(observed) / len(observed)
+        everything = [d for durations in self.durations.values() for d in durations]
+        return sum(everything) / len(everything) if everything else 0.
+
+    def state(self):
+        """Return the queue and observed run times as a JSON-serializable dict"""
+        return dict(
+            queue=[[job.image, job.arrival, job.seq] for job in self.queue],
+            submitted=self.submitted,
+            seq=self._seq,
+            launched=dict(self.launched),
+            durations=dict(self.durations),
+        )
+
+    def restore(self, state):
+        """Inverse of AdmissionController.state"""
+        self.queue = [QueuedJob(image, arrival, seq) for image, arrival, seq in state['queue']]
+        self.submitted = state['submitted']
+        self._seq = state['seq']
+        self.launched = {c_id: tuple(launch) for c_id, launch in state['launched'].items()}
+        self.durations = state['durations']
+        logger.info("Restored admission queue with {} jobs waiting".format(len(self.queue)))
+
+    def save(self):
+        """Write the queue to `<name>_admission.json`"""
+        write_checkpoint(self._state_fn, self.state())
+
+    def _priority(self, job):
+        if self.order == 'sef':
+            return self.expected_duration(job.image), job.seq
+        return job.seq
+
+    def _launch(self, job):
+        """Start a job with `docker run -d`
+
+        :return: the short ID of the container, or None if docker failed to start it
+        """
+        try:
+            c_id = subprocess.check_output(['docker', 'run', '-d', job.image]).decode('ascii').strip()[:12]
+        except subprocess.CalledProcessError as e:
+            c_id = None
+            logger.error('Could not launch `docker run {}`, dropping the job: {}'.format(job.image, e))
+        now = time.time()
+        delay = now - job.arrival
+        if c_id is not None:
+            self.launched[c_id] = (job.image, now)
+            logger.info('Launching container {} with `docker run {}` after queueing for {:.1f}s'.format(
+                c_id, job.image, delay))
+        with open(self._fn, 'a', newline='') as f:
+            csv.writer(f).writerow([job.image, round(job.arrival, 2), round(now, 2), round(delay, 2), c_id or '',
+                                    'failed' if c_id is None else 'launched'])
+        return c_id
+
+    def _record_exits(self, active):
+        """Learn run times from the launched containers that are no longer running
+
+        :return: True if any of them exited
+        """
+        exited = [c_id for c_id in self.launched if c_id not in active]
+        for c_id in exited:
+            image, started = self.launched.pop(c_id)
+            self.durations.setdefault(image, []).append(time.time() - started)
+        return len(exited) > 0
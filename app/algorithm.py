@@ -1,10 +1,11 @@
 """This module implements algorithm 1 from the paper
 """
+import time
 import logging
-
-from app.dockerutils import *
 import multiprocessing
 
+from app.allocation import multiplicative
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
@@ -12,21 +13,89 @@ fh = logging.FileHandler('FlowCon.log')
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+STATUS_COLUMNS = ('time', 'delta_t', 'iter', 'age', 'ignore', 'c_id', 'loss', 'progress', 'growth',
+                  'remaining_time', 'remaining_progress', 'limit', 'limit_norm', 'watching', 'completing')
+
+
+class StatusRecord(object):
+    """The state of one container after one run of algorithm 1: a row of the algo_1_iters table
+
+    delta_t and iter are filled in by the Trial.
+    """
+
+    __slots__ = STATUS_COLUMNS
+
+    def __init__(self, **fields):
+        for col in STATUS_COLUMNS:
+            setattr(self, col, fields.get(col))
+
+    def values(self):
+        """Return the fields of self in STATUS_COLUMNS order"""
+        return [getattr(self, col) for col in STATUS_COLUMNS]
+
+
+JOB_STATUS_COLUMNS = ('time', 'delta_t', 'iter', 'c_id', 'job', 'loss', 'progress', 'growth',
+                      'remaining_time', 'remaining_progress')
+
+
+class JobStatusRecord(object):
+    """The loss, progress and growth of one job inside a container after one run of algorithm 1
 
-def algo_1(containers, monitor, alpha=0.05, interval=30, no_update=False):
+    delta_t and iter are filled in by the Trial.
+    """
+
+    __slots__ = JOB_STATUS_COLUMNS
+
+    def __init__(self, **fields):
+        for col in JOB_STATUS_COLUMNS:
+            setattr(self, col, fields.get(col))
+
+    def values(self):
+        """Return the fields of self in JOB_STATUS_COLUMNS order"""
+        return [getattr(self, col) for col in JOB_STATUS_COLUMNS]
+
+
+def job_records(containers, now):
+    """Collect the per-job results of the last growth_tuple of each container as JobStatusRecords"""
+    records = []
+    for c in containers:
+        for job, (loss, progress, growth) in sorted(c.job_status.items()):
+            estimator = c.estimators.get(job)
+            records.append(JobStatusRecord(
+                time=now, c_id=c.id, job=job, loss=loss, progress=progress, growth=growth,
+                remaining_time=estimator.remaining_time if estimator is not None else None,
+                remaining_progress=estimator.remaining_progress if estimator is not None else None,
+            ))
+    return records
+
+
+def format_status(records):
+    """Format a list of StatusRecords as a table for printing"""
+    rows = [[str(col) for col in STATUS_COLUMNS]]
+    for r in records:
+        rows.append(['{:.4g}'.format(v) if isinstance(v, float) else str(v) for v in r.values()])
+    widths = [max(len(row[j]) for row in rows) for j in range(len(STATUS_COLUMNS))]
+    return '\n'.join('  '.join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
+
+
+def algo_1(containers, monitor, alpha=0.05, interval=30, no_update=False, policy=None, min_watch=0):
     """Run algorithm1 over a ContainerList
     :param containers: the ContainerList for the session
     :param monitor: the DockerMonitor for the session
     :param alpha: decision threshold for growth efficiency
     :param interval: time interval over which to run the algorithm
-    :return: a pandas DF of the status of all monitored containers after the run of the algorithm
+    :param policy: the allocation policy used to set limits, see app.allocation. Defaults to the multiplicative update
+    :param min_watch: seconds a container must have been watching before low growth marks it completing. When the
+                      algorithm runs more often than every `interval` (event-driven mode), setting this to `interval`
+                      keeps the rule that completing takes two separate intervals of low growth
+    :return: a list of StatusRecords, the status of all monitored containers after the run of the algorithm
 
     TODO refactor such that interval and alpha can vary independently for each container
     """
 
     logging.info("Running algorithm 1 with parameters alpha = {}, interval = {}".format(alpha, interval))
 
-    # accumulators for pandas DF
+    # accumulators for the status records
     growth = [None] * len(containers)
     loss = [None] * len(containers)
     progress = [None] * len(containers)
@@ -49,8 +118,12 @@ def algo_1(containers, monitor, alpha=0.05, interval=30, no_update=False):
         if G < alpha and not c.watching and not c.completing:
             logger.info("Marking {} as watching".format(c.id))
             c.watching = True
+            c.watching_since = time.time()
             c.completing = False
         elif G < alpha and c.watching and not c.completing:
+            if c.watching_since is not None and time.time() - c.watching_since < min_watch:
+                logger.info("Keeping {} as watching until it has been for {}s".format(c.id, min_watch))
+                continue
             logger.info("Marking {} as completing".format(c.id))
             c.watching = False
             c.completing = True
@@ -58,82 +131,29 @@ def algo_1(containers, monitor, alpha=0.05, interval=30, no_update=False):
             logger.info("Marking {} as neither watching nor completing".format(c.id))
             c.completing = False
             c.watching = False
+            c.watching_since = None
 
-    if containers.all_completing and not no_update:
-        try:
-            new_lim = 1.5 * 1/len(containers)
-        except ZeroDivisionError:
-            logger.warning("Containers finished while algorithm running", exc_info=True)
-        else:
-            new_lim = min(new_lim, 1)
-            new_lim = new_lim * multiprocessing.cpu_count()
-            for c in containers:
-                logger.info('freezing container {} limit to 1/n'.format(c.id))
-                c.frozen = True
-                c.cpu_lim = new_lim
-
-    elif containers.num_watching + containers.num_completing != len(containers):
-            # Apply resource limits from lines 16-22 of the algorithm as written in the paper
-            growth_sum = sum(filter(None, growth))
-            logger.info("Value for growth sum: {:.3f}".format(growth_sum))
-            for i, c in enumerate(containers):
-                current_normalized_lim = c.cpu_lim / multiprocessing.cpu_count()
-
-                if c.completing:
-                    growth = growth[i] if growth[i] is not None else 0  # TODO it seems like some containers can have None
-                    multiplier = (1 - (growth / (growth_sum + 1e-10)))  # for growth when they are completing...
-                elif c.watching or ignore[i]:
-                    continue
-                else:
-                    multiplier = (1 + (growth / growth_sum))
-
-        #        multiplier = max(0.5, multiplier)
-                new_lim = current_normalized_lim * multiplier
-
-                try:
-                    new_lim = max(new_lim, 1/10*len(containers))
-                except ZeroDivisionError:
-                    logger.warning("Containers finished while algorithm running", exc_info=True)
-                else:
-                    new_lim = min(new_lim, 1)
-                    if c.frozen:
-                        logger.info('container {} is frozen at 1/n'.format(c.id))
-                        new_lim = 1 / len(containers)
-                    if not no_update:
-                        logger.info("Updating container {} with\tgrowth={}\tmultiplier={}".format(c.id, growth[i], multiplier))
-                        new_lim_un_normalized = new_lim * multiprocessing.cpu_count()
-                        c.cpu_lim = round(new_lim_un_normalized, 2)
-    else:
-        # keep frozen containers frozen even if the previous block doesnt get hit
-        for c in containers:
-            if c.frozen and not no_update:
-                new_lim = 1 / len(containers) * multiprocessing.cpu_count()
-                c.cpu_lim = new_lim
-            if c.watching and not no_update:
-                c.cpu_lim = 1.5 / len(containers) * multiprocessing.cpu_count()
-
-
+    if policy is None:
+        policy = multiplicative
+    policy(containers, growth, ignore, no_update=no_update)
 
     now = time.time()
-    limits = [c.cpu_lim for c in containers]
-    W = [c.watching for c in containers]
-    C = [c.completing for c in containers]
-    ids = [c.id for c in containers]
-
-    status = pd.DataFrame(dict(
-        time=now,
-        c_id=ids,
-        age=ages,
-        ignore=ignore,
-        loss=loss,
-        progress=progress,
-        growth=growth,
-        limit=limits,
-        watching=W,
-        completing=C,
-    ))
-    status = status[['time', 'age', 'ignore', 'c_id', 'loss', 'progress', 'growth', 'limit', 'watching', 'completing']]
-
-    normalized_limit = status['limit'] / multiprocessing.cpu_count()
-    status.insert(8, 'limit_norm', normalized_limit)
+    cpus = multiprocessing.cpu_count()
+    status = []
+    for i, c in enumerate(containers):
+        status.append(StatusRecord(
+            time=now,
+            age=ages[i],
+            ignore=ignore[i],
+            c_id=c.id,
+            loss=loss[i],
+            progress=progress[i],
+            growth=growth[i],
+            remaining_time=c.remaining_time,
+            remaining_progress=c.remaining_progress,
+            limit=c.cpu_lim,
+            limit_norm=c.cpu_lim / cpus if c.cpu_lim is not None else None,
+            watching=c.watching,
+            completing=c.completing,
+        ))
     return status
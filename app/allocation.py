@@ -0,0 +1,182 @@
+"""CPU allocation policies applied after algorithm 1 has classified the containers
+
+A policy is a function `policy(containers, growth, ignore, no_update)` where `growth[i]` and `ignore[i]` are the
+growth efficiency and ignore flag algo_1 computed for the i-th container of the ContainerList. A policy sets
+`cpu_lim` on the containers it wants to change (unless `no_update`) and returns None.
+
+    multiplicative: the update from lines 16-22 of algorithm 1 in the paper
+    waterfill: a weighted max-min (water-filling) allocation of exactly the host's cpus
+    remaining: water-filling weighted by the predicted remaining progress of each container's jobs
+"""
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+fh = logging.FileHandler('FlowCon.log')
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+
+def multiplicative(containers, growth, ignore, no_update=False):
+    """Scale each container's limit by 1 +/- its share of the total growth, as written in the paper
+
+    Does not guarantee that the limits sum to the number of cpus on the host.
+    """
+    if containers.all_completing and not no_update:
+        try:
+            new_lim = 1.5 * 1/len(containers)
+        except ZeroDivisionError:
+            logger.warning("Containers finished while algorithm running", exc_info=True)
+        else:
+            new_lim = min(new_lim, 1)
+            new_lim = new_lim * multiprocessing.cpu_count()
+            for c in containers:
+                logger.info('freezing container {} limit to 1/n'.format(c.id))
+                c.frozen = True
+                c.cpu_lim = new_lim
+
+    elif containers.num_watching + containers.num_completing != len(containers):
+            # Apply resource limits from lines 16-22 of the algorithm as written in the paper
+            growth_sum = sum(filter(None, growth))
+            logger.info("Value for growth sum: {:.3f}".format(growth_sum))
+            for i, c in enumerate(containers):
+                current_normalized_lim = c.cpu_lim / multiprocessing.cpu_count()
+
+                if c.completing:
+                    g = growth[i] if growth[i] is not None else 0  # TODO it seems like some containers can have None
+                    multiplier = (1 - (g / (growth_sum + 1e-10)))  # for growth when they are completing...
+                elif c.watching or ignore[i]:
+                    continue
+                else:
+                    multiplier = (1 + (growth[i] / growth_sum))
+
+        #        multiplier = max(0.5, multiplier)
+                new_lim = current_normalized_lim * multiplier
+
+                try:
+                    new_lim = max(new_lim, 1/10*len(containers))
+                except ZeroDivisionError:
+                    logger.warning("Containers finished while algorithm running", exc_info=True)
+                else:
+                    new_lim = min(new_lim, 1)
+                    if c.frozen:
+                        logger.info('container {} is frozen at 1/n'.format(c.id))
+                        new_lim = 1 / len(containers)
+                    if not no_update:
+                        logger.info("Updating container {} with\tgrowth={}\tmultiplier={}".format(c.id, growth[i], multiplier))
+                        new_lim_un_normalized = new_lim * multiprocessing.cpu_count()
+                        c.cpu_lim = round(new_lim_un_normalized, 2)
+    else:
+        # keep frozen containers frozen even if the previous block doesnt get hit
+        for c in containers:
+            if c.frozen and not no_update:
+                new_lim = 1 / len(containers) * multiprocessing.cpu_count()
+                c.cpu_lim = new_lim
+            if c.watching and not no_update:
+                c.cpu_lim = 1.5 / len(containers) * multiprocessing.cpu_count()
+
+
+def water_fill(weights, capacity, floors, caps):
+    """Weighted max-min allocation of `capacity` in O(n log n)
+
+    Finds the level L such that sum(clip(L * w_i, floor_i, cap_i)) == capacity, so every job gets a share proportional
+    to its weight except where a floor or cap binds. If the caps sum to less than `capacity` every job gets its cap;
+    if the floors sum to more than `capacity` the floors are scaled down to fit.
+
+    :param weights: non-negative weights, one per job
+    :param capacity: the total amount to allocate
+    :param floors: per-job minimum allocations
+    :param caps: per-job maximum allocations, each >= the corresponding floor
+    :return: a list of allocations, one per job
+    """
+    if len(weights) == 0:
+        return []
+    if sum(caps) <= capacity:
+        return list(caps)
+    floor_sum = sum(floors)
+    if floor_sum >= capacity:
+        return [f * capacity / floor_sum for f in floors]
+
+    # Zero-weight jobs only receive what is left once every other job is capped
+    tiny = 1e-9 * max(max(weights), 1e-9)
+    weights = [w if w > 0 else tiny for w in weights]
+
+    # Job i is pinned at its floor for L <= floors[i]/w_i, grows with slope w_i, and is pinned at its cap for
+    # L >= caps[i]/w_i. Sweep the sorted breakpoints keeping the total at the current level and its slope.
+    events = []
+    for w, f, c in zip(weights, floors, caps):
+        events.append((f / w, w))    # starts growing
+        events.append((c / w, -w))   # stops growing
+    events.sort()
+
+    total = floor_sum   # allocated at the current level
+    slope = 0.          # d(total)/dL
+    level = 0.
+    for point, d_slope in events:
+        reached = total + slope * (point - level)
+        if reached >= capacity:
+            break
+        level, total = point, reached
+        slope += d_slope
+    if slope > 0:
+        level += (capacity - total) / slope
+
+    return [min(max(level * w, f), c) for w, f, c in zip(weights, floors, caps)]
+
+
+def _fill_by_score(containers, scores, no_update, min_share, max_share):
+    """Water-fill the host's cpus over `containers` weighted by `scores` (None for containers without one)"""
+    n = len(containers)
+    if n == 0 or no_update:
+        return
+    capacity = multiprocessing.cpu_count()
+    if min_share is None:
+        min_share = 1 / (10 * n)
+
+    known = [score for score in scores if score is not None]
+    default = sum(known) / len(known) if known else 0
+    weights = [default if score is None else max(score, 0) for score in scores]
+    if sum(weights) <= 0:
+        weights = [1.] * n
+
+    floors = [min_share * capacity] * n
+    caps = [max_share * capacity] * n
+    limits = water_fill(weights, capacity, floors, caps)
+    logger.info("Water-filling {} cpus over {} containers".format(capacity, n))
+
+    for c, w, lim in zip(containers, weights, limits):
+        logger.info("Updating container {} with\tweight={}\tlimit={}".format(c.id, w, lim))
+        c.cpu_lim = round(lim, 2)
+
+
+def waterfill(containers, growth, ignore, no_update=False, min_share=None, max_share=1.):
+    """Assign all of the host's cpus in proportion to growth efficiency, with per-job floors and caps
+
+    Containers without a growth score yet (ignored by algo_1) are weighted with the mean growth of the others so
+    that new arrivals get a fair share. If no container has positive growth the cpus are split evenly.
+
+    :param min_share: per-job floor as a fraction of the host, defaults to 1/(10n)
+    :param max_share: per-job cap as a fraction of the host
+    """
+    scores = [None if ign else g for g, ign in zip(growth, ignore)]
+    _fill_by_score(containers, scores, no_update, min_share, max_share)
+
+
+def remaining(containers, growth, ignore, no_update=False, min_share=None, max_share=1.):
+    """Like waterfill, but weight each container by the normalized loss its jobs are predicted to still shed
+
+    The prediction comes from the loss curves fitted in app.estimator, so cpu shifts towards the jobs with the most
+    useful progress left rather than the ones that happened to move most in the last interval. Containers without a
+    decaying fit (too few points, or a loss that is flat or rising) get the mean weight.
+    """
+    scores = [c.remaining_progress for c in containers]
+    _fill_by_score(containers, scores, no_update, min_share, max_share)
+
+
+POLICIES = {
+    'multiplicative': multiplicative,
+    'waterfill': waterfill,
+    'remaining': remaining,
+}
@@ -0,0 +1,57 @@
+"""Crash-safe snapshots of controller state
+
+A checkpoint is a single JSON document holding the Trial parameters and counters, the per-container algorithm state
+(watching/completing/frozen flags, limits, creation time) and the recent metric windows the algorithm reads from.
+The results of each iteration are not included; the Trial appends them to its csvs as they are produced.
+It is rewritten after every iteration of Trial.run so that `run_trial.py --resume` can pick up where a crashed
+controller left off instead of treating every running job as new.
+"""
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+fh = logging.FileHandler('FlowCon.log')
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+
+def checkpoint_path(name):
+    """Return the checkpoint filename for the Trial called `name`"""
+    return '{}_checkpoint.json'.format(name)
+
+
+def write_checkpoint(path, state):
+    """Atomically write `state` to `path`
+
+    The snapshot is written to a temporary file and renamed over the previous one, so a crash mid-write leaves the
+    last complete checkpoint in place.
+
+    :param path: the checkpoint filename
+    :param state: a JSON-serializable dict
+    :return: None
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    logger.debug("Wrote checkpoint to {}".format(path))
+
+
+def read_checkpoint(path):
+    """Load a checkpoint written by write_checkpoint
+
+    :param path: the checkpoint filename
+    :return: the state dict
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError("No checkpoint found at {}, cannot resume".format(path))
+    with open(path) as f:
+        state = json.load(f)
+    logger.info("Read checkpoint from {}".format(path))
+    return state
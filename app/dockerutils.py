@@ -5,6 +5,10 @@
             write consistently formatted log statements
             flush stdout after every log statement
 
+        Progress records look like `Loss: 0.123 Time: 1528919021.5`. A container may run several jobs, in which case
+        each record also carries a job identifier, e.g. `Job: gru Loss: 0.123 Time: 1528919021.5`. Records without
+        one belong to job DEFAULT_JOB.
+
         Have a directory called /docker_data where all of your jobs are located
 
         Have all of your required docker images installed
@@ -15,15 +19,20 @@ import subprocess
 from subprocess import DEVNULL
 from multiprocessing import cpu_count
 import re
+import json
 import time
 import warnings
 import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import numpy as np
 
 
 from app.threadutils import RepeatedTimer
+from app.estimator import LossCurveEstimator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -32,33 +41,135 @@ fh = logging.FileHandler('FlowCon.log')
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+
+STATS_COLUMNS = ['container_id', 'cpu_frac', 'cpu_norm', 'mem_use', 'mem_max', 'mem_frac',
+                 'net_in', 'net_out', 'block_in', 'block_out', 'pids']
+HISTORY_COLUMNS = STATS_COLUMNS + ['time']
+
+# Multipliers for the size suffixes docker prints (go-units: decimal for network/block I/O, binary for memory)
+_UNITS = {'': 1., 'B': 1.,
+          'kB': 1e3, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12, 'PB': 1e15,
+          'KiB': 2.**10, 'MiB': 2.**20, 'GiB': 2.**30, 'TiB': 2.**40, 'PiB': 2.**50}
+
+# A number as docker prints it with %.3g (e.g. '1e+03'), followed by an optional unit
+_SIZE = re.compile(r'^([0-9.]+(?:[eE][+-]?[0-9]+)?)\s*([A-Za-z]*)$')
+
+_LOSS = re.compile(b'Loss: ([0-9.]+)')
+_TIME = re.compile(b'Time: ([0-9.]+)')
+_JOB = re.compile(b'Job: ([^\\s,;]+)')
+
+DEFAULT_JOB = '0'
+
+
+def _to_float(strings):
+    """Convert an array of numeric strings to float64; anything else (e.g. '--' for an exiting container) is NaN
+
+    The whole array is cast at once, falling back to casting each string only if some of them are not numbers.
+    """
+    strings = np.char.strip(strings)
+    try:
+        return strings.astype(np.float64)
+    except ValueError:
+        values = np.full(strings.shape, np.nan)
+        for i, string in enumerate(strings):
+            try:
+                values[i] = float(string)
+            except ValueError:
+                pass
+        return values
+
+
+def _to_bytes(sizes):
+    """Convert an array of docker size strings such as '1.2GiB', '512kB' or '1e+03kB' to float64 bytes"""
+    matches = [_SIZE.match(size) for size in np.char.strip(sizes)]
+    numbers = np.array([m.group(1) if m else '' for m in matches], dtype=str)
+    scale = np.array([_UNITS.get(m.group(2), np.nan) if m else np.nan for m in matches])
+    return _to_float(numbers) * scale
+
+
+def _to_fraction(percentages):
+    """Convert an array of docker percentage strings such as '12.5%' to float64 fractions"""
+    return _to_float(np.char.rstrip(percentages, '%')) / 100
+
+
+def _split_pair(pairs):
+    """Split an array of 'a / b' strings into two arrays"""
+    parts = np.char.partition(pairs, '/')
+    return parts[:, 0], parts[:, 2]
+
+
+def parse_stats(output):
+    """Parse the output of `docker stats --no-stream --format '{{json .}}'` into normalized columns
+
+    Conversion is done column-wise over the whole batch rather than per record.
+
+    :param output: the decoded stdout of docker stats, one JSON object per line
+    :return: a dict mapping each of STATS_COLUMNS to a numpy array, all numeric columns as float64
+    """
+    records = [json.loads(line) for line in output.splitlines() if line.strip()]
+    if len(records) == 0:
+        return {col: np.array([], dtype=str if col == 'container_id' else np.float64) for col in STATS_COLUMNS}
+
+    def column(key):
+        return np.array([r.get(key, '') for r in records], dtype=str)
+
+    mem_use, mem_max = _split_pair(column('MemUsage'))
+    net_in, net_out = _split_pair(column('NetIO'))
+    block_in, block_out = _split_pair(column('BlockIO'))
+    cpu_frac = _to_fraction(column('CPUPerc'))
+
+    return dict(
+        container_id=column('ID'),
+        cpu_frac=cpu_frac,
+        cpu_norm=cpu_frac / cpu_count(),
+        mem_use=_to_bytes(mem_use),
+        mem_max=_to_bytes(mem_max),
+        mem_frac=_to_fraction(column('MemPerc')),
+        net_in=_to_bytes(net_in),
+        net_out=_to_bytes(net_out),
+        block_in=_to_bytes(block_in),
+        block_out=_to_bytes(block_out),
+        pids=_to_float(column('PIDs')),
+    )
+
+
 class ContainerWrapper(object):
     """A python interface to docker containers running ML jobs
 
     Allows us to monitor the state of evaluation functions and update resource limits.
     """
 
-    def __init__(self, id=None, create=False, image=None, wd=None, script=None, njobs=1):
+    __slots__ = ('id', 'quota', '_cpuset', '_mem_limit', '_cpu_lim', 'njobs', 'job_status', 'curve_model',
+                 'estimators', 'watching', 'watching_since', 'completing', 'frozen', '_creation_time')
+
+    def __init__(self, id=None, create=False, image=None, wd=None, script=None, njobs=1, quota=True,
+                 curve_model='exp'):
         """
         :param id: Container ID: if create=True then this has no effect
         :param create: if True, the ContainerWrapper will create a container based on `image`, `wd`, and `script`
         :param image: see `create`
         :param wd: see `create`
         :param script: see `create`
-        :param njobs: number of ML jobs running within the container. Currently only supports 1.
+        :param njobs: number of ML jobs expected in the container. It is raised to the number of jobs found in the logs
+        :param quota: if False, setting cpu_lim only records the limit and the cpuset is used for enforcement instead
+        :param curve_model: the decay model fitted to each job's loss history, see app.estimator
         """
         self.id = id
         if create:
             self._run(image, wd, script)
+        self.quota          = quota
+        self.cpuset         = None
         self.mem_lim        = None
         self.cpu_lim        = None
         self.njobs          = njobs
+        self.job_status     = {}     # job id -> (loss, progress, growth) from the last growth_tuple
+        self.curve_model    = curve_model
+        self.estimators     = {}     # job id -> LossCurveEstimator
         self.watching       = None   # TODO: In my option, these properties are pretty sloppy OO.
+        self.watching_since = None   # time at which the container was last marked watching
         self.completing     = None   # They are essentially using a ContainerWrapper object to store data for logic
         self.frozen         = False  # external to the container object leading to class bloat
         self._creation_time = time.time()
-        if njobs != 1:
-            raise NotImplementedError('Currently only supports one job')
 
     def _run(self, image, wd, script):
         """ Create a container from an image. Currently this only works on the mtynes_docker_kube CloudLab image.
@@ -72,49 +183,87 @@ class ContainerWrapper(object):
                          "-w {} {} python {}".format(wd, image, script)
         self.id = subprocess.check_output(command_string.split()).decode('ascii')[:-1]
 
-    @property
-    def loss_table(self):
-        """Parse the container logs and return a pd.DataFrame of the loss function over the lifetime of the container"""
-
-        if self.njobs == 1:
-            logs = subprocess.check_output(['docker', 'logs', self.id])
-            logs = logs.split(b"\n")
-            loss = []
-            timestamp = []
-            for line in logs[:-1]:
-                try:
-                    l = float(re.search(b'Loss: ([0-9.]+)', line).group(1))
-                    t = float(re.search(b'Time: ([0-9.]+)', line).group(1))
-                except AttributeError:  # If re.search returns NoneType, which has no attribute 'group'
-                    continue
-                else:
-                    loss.append(l)
-                    timestamp.append(t)
-
-            history = pd.DataFrame({'loss': loss, 'time': timestamp})
+    def loss_history(self):
+        """Parse the container logs into the loss function of each job over the lifetime of the container
 
-        else:
-            raise NotImplementedError("This should never happen: currently only supports one job")
-            # When more than one job is supported, this method will have to change
+        :return: a dict of job id -> pair of float64 arrays (time, loss)
+        """
+
+        logs = subprocess.check_output(['docker', 'logs', self.id])
+        logs = logs.split(b"\n")
+        history = {}
+        for line in logs[:-1]:
+            try:
+                l = float(_LOSS.search(line).group(1))
+                t = float(_TIME.search(line).group(1))
+            except AttributeError:  # If re.search returns NoneType, which has no attribute 'group'
+                continue
+            else:
+                job = _JOB.search(line)
+                job = job.group(1).decode('ascii', 'replace') if job is not None else DEFAULT_JOB
+                timestamp, loss = history.setdefault(job, (array('d'), array('d')))
+                loss.append(l)
+                timestamp.append(t)
+
+        self.njobs = max(self.njobs, len(history))
+        return {job: (np.array(timestamp, dtype=np.float64), np.array(loss, dtype=np.float64))
+                for job, (timestamp, loss) in history.items()}
 
-        return history
+    @property
+    def loss_table(self):
+        """Parse the container logs and return a pd.DataFrame of the loss function of each job over the lifetime of
+        the container"""
+        import pandas as pd
+        tables = [pd.DataFrame({'loss': loss, 'time': timestamp, 'job': job}, columns=['loss', 'time', 'job'])
+                  for job, (timestamp, loss) in sorted(self.loss_history().items())]
+        if len(tables) == 0:
+            return pd.DataFrame(columns=['loss', 'time', 'job'])
+        return pd.concat(tables, ignore_index=True)
+
+    def count_new_points(self, since):
+        """Count the loss records the container has logged since a given time
+
+        Only the tail of the logs is read (`docker logs --since`), but each call still starts a docker process.
+
+        :param since: a unix timestamp
+        :return: int
+        """
+        logs = subprocess.check_output(['docker', 'logs', '--since', '{:.3f}'.format(since), self.id],
+                                       stderr=DEVNULL)
+        return len(re.findall(b'Loss: [0-9.]+', logs))
 
     @property
     def cpu_lim(self):
         """CPU limit placed on container where the unit is the number of cpus
 
-        Setting cpu_lim causes an instance to run `docker update self.id --cpus limit`
+        Setting cpu_lim causes an instance to run `docker update self.id --cpus limit`, unless self.quota is False
         """
         return self._cpu_lim
 
     @cpu_lim.setter
     def cpu_lim(self, limit):
-        if limit is not None:
+        if limit is not None and self.quota:
             logger.info("Setting container {} cpu limit to {}".format(self.id, limit))
             response = subprocess.check_output(['docker', 'update', '--cpus', str(limit), self.id])
             logger.info("Docker response: {}".format(response))
         self._cpu_lim = limit
 
+    @property
+    def cpuset(self):
+        """The cpus the container may run on, as a kernel cpu list such as '0-3,8'
+
+        Setting cpuset causes an instance to run `docker update self.id --cpuset-cpus cpuset`
+        """
+        return self._cpuset
+
+    @cpuset.setter
+    def cpuset(self, cpuset):
+        if cpuset is not None:
+            logger.info("Setting container {} cpuset to {}".format(self.id, cpuset))
+            response = subprocess.check_output(['docker', 'update', '--cpuset-cpus', cpuset, self.id])
+            logger.info("Docker response: {}".format(response))
+        self._cpuset = cpuset
+
     @property
     def mem_lim(self):
         """Memory limit placed on container
@@ -131,6 +280,18 @@ class ContainerWrapper(object):
             logger.info("Docker response: {}".format(response))
         self._mem_limit = limit
 
+    @property
+    def remaining_time(self):
+        """Predicted seconds until the slowest job in the container converges, None if no job has a decaying fit"""
+        times = [e.remaining_time for e in self.estimators.values() if e.remaining_time is not None]
+        return max(times) if times else None
+
+    @property
+    def remaining_progress(self):
+        """Predicted normalized loss still to be shed by the jobs in the container, None if no job has a decaying fit"""
+        progress = [e.remaining_progress for e in self.estimators.values() if e.remaining_progress is not None]
+        return sum(progress) if progress else None
+
     @property
     def age(self):
         return time.time() - self._creation_time
@@ -140,6 +301,10 @@ class ContainerWrapper(object):
 
         GROWTH WILL BE SET TO 0 if no history yet, if this happens twice it will be marked as completing...
 
+        With several jobs in the container, loss, progress and growth are computed for each job and stored in
+        self.job_status, with the container's cpu split evenly between the jobs that reported progress. The container
+        triple combines them: the mean loss, the total progress, and the total progress per unit of container cpu.
+
         :param container: a ContainerWrapper object
         :param monitor: a DockerMonitor object
         :param interval: the time interval over which to compute growth efficiency in seconds
@@ -150,17 +315,20 @@ class ContainerWrapper(object):
         """
         logger.info("Generating growth tuple for container {} with interval {}".format(self.id, interval))
 
-        E_i, progress_score = self._loss_and_progress(interval)
+        jobs = self._loss_and_progress(interval)
+        self.job_status = {job: (E, P, None) for job, (E, P) in jobs.items()}
+        losses = [E for E, _ in jobs.values() if not np.isnan(E)]
+        E_i = sum(losses) / len(losses) if losses else np.nan
+        progress = [P for _, P in jobs.values() if P is not None]
 
-        if progress_score is None:
+        if len(progress) == 0:
             logger.info("Returning None for growth score")
             return E_i, None, None
+        progress_score = sum(progress)
 
-        resources = monitor.history
-        resources = resources[resources.container_id == self.id]
-        resources = resources[resources.time >= (time.time() - interval)]
+        cpu_mean = monitor.cpu_mean(self.id, time.time() - interval)
 
-        if resources.shape[0] == 0:
+        if cpu_mean is None:
             # then we dont have any resource history for this container yet, so it cant have grown efficiently.
 
             warn_str = "No resources history in this interval  for container: {}, returning growth of 0".format(self.id)
@@ -168,15 +336,15 @@ class ContainerWrapper(object):
             logger.warning(warn_str)
             return E_i, None, None
 
-        resources['cpu_pct'] = resources.cpu_pct.str.rstrip('%').astype(float)
-        resources['cpu_norm'] = resources.cpu_pct / cpu_count() / 100
-        resources['mem_norm'] = resources.mem_pct.str.rstrip('%').astype(float) / 100
-        cpu_mean = resources.cpu_norm.mean()
-
         if cpu_mean < threshold:
             raise NotImplementedError("Got CPU mean of {}, which is <= threshold of {}".format(cpu_mean, threshold))
         else:
             growth = progress_score / cpu_mean
+            for job, (E, P) in jobs.items():
+                if P is not None:
+                    self.job_status[job] = (E, P, P / (cpu_mean / len(progress)))
+                    logger.info("Job {} in {}: loss = {} progress = {} growth = {}".format(
+                        job, self.id, *self.job_status[job]))
             logger.info("Returning loss = {} progress = {} growth = {} for {}".format(E_i, progress_score, growth, self.id))
             return E_i, progress_score, growth
 
@@ -190,49 +358,110 @@ class ContainerWrapper(object):
         logger.info("Saving logs for container {}".format(self.id))
         table.to_csv("{}_{}.csv".format(experiment_name, self.id), index=False)
 
+    def state(self):
+        """Return the algorithm state of self as a JSON-serializable dict, for checkpointing"""
+        return dict(
+            id=self.id,
+            cpu_lim=self.cpu_lim,
+            mem_lim=self.mem_lim,
+            cpuset=self.cpuset,
+            quota=self.quota,
+            njobs=self.njobs,
+            curve_model=self.curve_model,
+            estimators={job: e.state() for job, e in self.estimators.items()},
+            watching=self.watching,
+            watching_since=self.watching_since,
+            completing=self.completing,
+            frozen=self.frozen,
+            creation_time=self._creation_time,
+        )
+
+    @classmethod
+    def from_state(cls, state, no_update=False):
+        """Reattach to a running container from a dict produced by ContainerWrapper.state
+
+        :param state: see ContainerWrapper.state
+        :param no_update: if True, do not re-apply the saved limits with `docker update`
+        :return: a ContainerWrapper
+        """
+        c = cls(id=state['id'], njobs=state['njobs'], quota=state['quota'], curve_model=state['curve_model'])
+        c.estimators = {job: LossCurveEstimator.from_state(e) for job, e in state['estimators'].items()}
+        if no_update:
+            c._cpu_lim = state['cpu_lim']
+            c._mem_limit = state['mem_lim']
+            c._cpuset = state['cpuset']
+        else:
+            c.cpu_lim = state['cpu_lim']
+            c.mem_lim = state['mem_lim']
+            c.cpuset = state['cpuset']
+        c.watching = state['watching']
+        c.watching_since = state['watching_since']
+        c.completing = state['completing']
+        c.frozen = state['frozen']
+        c._creation_time = state['creation_time']
+        return c
+
     def kill(self):
         """Kill the container controlled by self"""
         subprocess.run(['docker', 'container', 'kill', self.id], stdout=DEVNULL)
 
     def _loss_and_progress(self, interval):
-        """Compute the loss and progress score over the `interval` for use in Algorithm 1
+        """Compute the loss and progress score of each job over the `interval` for use in Algorithm 1
 
         :param: interval: number of seconds defining a time interval
-        :return: (loss over interval, progress score over interval)
+        :return: a dict of job id -> (loss over interval, progress score over interval)
         """
 
 
         logger.info('Computing mean loss over intervals i and i-1 progress scores')
-        loss_history = self.loss_table
-        loss_history['loss'] = loss_history.loss / loss_history.loss.max()  # normalize loss
         now = time.time()
-
-        # See writeup of Algorithm 1 in paper to disambiguate notational choices here
-        loss_over_this_interval = loss_history.loss[loss_history.time >= now - interval]
-        loss_over_previous_interval = loss_history.loss[(now - 2 * interval <= loss_history.time) & (loss_history.time <= now - interval)]
-
-        E_i = loss_over_this_interval.mean()
-        E_i_minus_1 = loss_over_previous_interval.mean()
-
-        if len(loss_over_previous_interval) == 0:
-            logger.info("No loss over previous interval, returning None for progress score")
-            return E_i, None
-        else:
-            progress = abs(E_i - E_i_minus_1) / interval
-            return E_i, progress
+        jobs = {}
+        for job, (timestamp, loss) in self.loss_history().items():
+            if job not in self.estimators:
+                self.estimators[job] = LossCurveEstimator(model=self.curve_model)
+            self.estimators[job].update_many(timestamp, loss)
+            loss = loss / loss.max()  # normalize loss
+
+            # See writeup of Algorithm 1 in paper to disambiguate notational choices here
+            loss_over_this_interval = loss[timestamp >= now - interval]
+            loss_over_previous_interval = loss[(now - 2 * interval <= timestamp) & (timestamp <= now - interval)]
+
+            E_i = loss_over_this_interval.mean() if len(loss_over_this_interval) else np.nan
+            E_i_minus_1 = loss_over_previous_interval.mean() if len(loss_over_previous_interval) else np.nan
+
+            if len(loss_over_previous_interval) == 0:
+                logger.info("No loss over previous interval for job {}, returning None for progress score".format(job))
+                jobs[job] = (E_i, None)
+            elif len(loss_over_this_interval) == 0:
+                logger.info("No loss over this interval for job {}, returning None for progress score".format(job))
+                jobs[job] = (E_i, None)
+            else:
+                jobs[job] = (E_i, abs(E_i - E_i_minus_1) / interval)
+        return jobs
 
 
 class ContainerList(object):
-    """A list-like object for storing ContainerWrappers"""
+    """A list-like object for storing ContainerWrappers
 
-    def __init__(self, no_update=False, *args):
+    Containers are held in a dict keyed by container ID, in the order they were added. The logs of containers that
+    exit are saved by a background pool so that reconcile does not block on `docker logs`.
+    """
+
+    def __init__(self, no_update=False, *args, quota=True, curve_model='exp', log_workers=4):
         """Create self from a comma-separated list of ContainerWrappers
         :param *args: ContainerWrapper objects to store in instance
+        :param quota: passed to the ContainerWrappers created by reconcile, see ContainerWrapper
+        :param curve_model: passed to the ContainerWrappers created by reconcile, see ContainerWrapper
+        :param log_workers: number of threads saving the logs of exited containers
         """
 
         logger.info("Initializing ContainerList")
         self.no_update = no_update
-        self.containers = []
+        self.quota = quota
+        self.curve_model = curve_model
+        self.containers = {}
+        self._log_pool = ThreadPoolExecutor(max_workers=log_workers)
+        self._log_futures = []
         self.add(*args)
 
     def add(self, *args):
@@ -247,7 +476,12 @@ class ContainerList(object):
                 raise ValueError("ContainerList can only take ContainerWrapper objects, got {}".format(type(arg)))
 
         # logger.info("Adding {} containers to ContainerList".format(len(args)))
-        self.containers.extend(list(args))
+        for arg in args:
+            self.containers[arg.id] = arg
+
+    def get(self, c_id, default=None):
+        """Return the ContainerWrapper with ID `c_id`, or `default` if it is not in self"""
+        return self.containers.get(c_id, default)
 
     def reconcile(self, experiment_name):
         """Reconcile the state of the container list with the state of currently active containers
@@ -261,37 +495,83 @@ class ContainerList(object):
         logger.info('Reconciling ContainerList with docker ps')
 
         active_containers = subprocess.check_output(['docker', 'ps', '-q']).decode('ascii').split('\n')[:-1]
+        active = set(active_containers)
+        known = self.ids
 
         for c_id in active_containers:
-            if c_id not in self.ids:
-                c = ContainerWrapper(id=c_id)
+            if c_id not in known:
+                c = ContainerWrapper(id=c_id, quota=self.quota, curve_model=self.curve_model)
                 logger.info('Adding {} to ContainerList'.format(c_id))
                 self.add(c)
 
+        for c_id in known - active:
+            logger.info('Removing {} from ContainerList'.format(c_id))
+            self.save_logs_async(self.containers.pop(c_id), experiment_name)
+
         for c in self:
-            if c.id not in active_containers:
-                logger.info('Removing {} from ContainerList'.format(c.id))
-                c.save_logs(experiment_name=experiment_name)
-                self.containers.remove(c)
             if c.cpu_lim is None:
                 new_lim = cpu_count()
                 if not self.no_update:
                     logger.info("Container {} has limit = None, updating...".format(c.id))
                     c.cpu_lim = new_lim  # TODO this is a rather strange place for this to happen
 
+    def state(self):
+        """Return a list of the checkpoint states of the containers in self"""
+        return [c.state() for c in self]
+
+    def restore(self, states, experiment_name):
+        """Reattach to the containers in a checkpoint that are still running
+
+        The logs of containers that exited while the controller was down are saved in the background; new containers
+        are picked up by reconcile.
+
+        :param states: a list produced by ContainerList.state
+        :param experiment_name: the name of the controlling Trial instance
+        :return: None
+        """
+        active_containers = set(subprocess.check_output(['docker', 'ps', '-q']).decode('ascii').split('\n')[:-1])
+        for state in states:
+            if state['id'] not in active_containers:
+                logger.info('Checkpointed container {} is no longer running, saving its logs'.format(state['id']))
+                self.save_logs_async(ContainerWrapper.from_state(state, no_update=True), experiment_name)
+                continue
+            logger.info('Reattaching to container {}'.format(state['id']))
+            self.add(ContainerWrapper.from_state(state, no_update=self.no_update))
+
+    def save_logs_async(self, container, experiment_name):
+        """Save the logs of `container` on the background pool
+
+        :param container: a ContainerWrapper, usually one that has exited
+        :param experiment_name: the name of the controlling Trial instance
+        :return: None
+        """
+        self._log_futures = [f for f in self._log_futures if not f.done()]
+        self._log_futures.append(self._log_pool.submit(_save_logs, container, experiment_name))
+
+    def wait_for_logs(self):
+        """Block until every log capture submitted so far has finished"""
+        for future in self._log_futures:
+            future.result()
+        self._log_futures = []
+
     def __iter__(self):
-        for container in self.containers:
+        # Iterate over a snapshot so that reconcile can add and remove containers meanwhile
+        for container in list(self.containers.values()):
             yield container
 
+    def __contains__(self, c_id):
+        return c_id in self.containers
+
     def __len__(self):
         return len(self.containers)
 
     def killall(self, experiment_name, save_logs=True):
-        """Kill all ContainerWrappers in self"""
+        """Kill all ContainerWrappers in self, and wait for all pending log captures"""
         for container in self:
             if save_logs:
-                container.save_logs(experiment_name=experiment_name)
+                self.save_logs_async(container, experiment_name)
             container.kill()
+        self.wait_for_logs()
 
     @property
     def all_completing(self):
@@ -315,8 +595,16 @@ class ContainerList(object):
 
     @property
     def ids(self):
-        """Return a list of container IDs corresponding to the containers stored in self"""
-        return [c.id for c in self]
+        """Return the set of container IDs corresponding to the containers stored in self"""
+        return set(self.containers)
+
+
+def _save_logs(container, experiment_name):
+    """Save the logs of a container, logging rather than raising errors so that they do not vanish in the pool"""
+    try:
+        container.save_logs(experiment_name=experiment_name)
+    except Exception:
+        logger.exception("Could not save logs for container {}".format(container.id))
 
 
 class ResourceMonitor(object):
@@ -324,7 +612,8 @@ class ResourceMonitor(object):
 
     Meant to be used as a singleton.
 
-    Runs `docker stats --no-stream` every n seconds using a RepeatedTimer object, accumulating results into a DataFrame
+    Runs `docker stats --no-stream` every n seconds using a RepeatedTimer object, accumulating results into flat
+    `array('d')` columns (plus a per-container index of cpu usage for the algorithm). Call `history` for a DataFrame.
     """
 
     def __init__(self, update_interval=10):
@@ -332,33 +621,95 @@ class ResourceMonitor(object):
         :param update_interval: how frequently, in seconds, to update docker stats table
         """
         logger.info('Initializing ResourceMonitor with update interval = {}'.format(update_interval))
-        self.history = self._check_stats()
+        self._lock = threading.Lock()
+        self._ids = []
+        self._columns = {col: array('d') for col in HISTORY_COLUMNS[1:]}
+        self._cpu = {}  # container id -> (array of times, array of cpu_norm)
+        self._append(self._check_stats())
         self._update_interval = update_interval
         self._timer = RepeatedTimer(interval=self._update_interval, function=self._update)
         self._timer.start()
+
     def _check_stats(self):
-        """Run `docker stats --no-stream` and parse into pd.DataFrame
+        """Run `docker stats --no-stream` and parse into columns
 
-        TODO the columns printed vary with docker versions... standardize this somehow.
-        TODO note: had to install docker version 17 and anaconda on chameleon for this to work
+        Stats are requested as one JSON object per container (`--format '{{json .}}'`), so parsing does not depend on
+        the column layout of a particular docker version. All quantities are normalized at ingest:
+            cpu_frac, cpu_norm, mem_frac: fractions (cpu_frac of one cpu, cpu_norm of the whole host)
+            mem_use, mem_max, net_in, net_out, block_in, block_out: bytes as float64
         """
 
         logger.debug('ResourceMonitor: checking stats')
-        columns = ['container_id', 'cpu_pct', 'mem_use', 'mem_max',
-                   'mem_pct', 'net_in', 'net_out', 'block_in', 'block_out', 'pids']
-
-        records = subprocess.check_output(['docker', 'stats', '--no-stream']).decode('ascii')
-        records = records.split('\n')[1:-1]  # exclude headers and trailing empty string
-        records = [re.split('[ /]+', record) for record in records]
-
-        stats = pd.DataFrame.from_records(records, columns=columns)
-        stats['time'] = time.time()
+        records = subprocess.check_output(['docker', 'stats', '--no-stream', '--format', '{{json .}}']).decode('utf-8')
+        stats = parse_stats(records)
+        stats['time'] = np.full(len(stats['container_id']), time.time())
         logger.debug('ResourceMonitor: done checking stats')
         return stats
 
+    def _append(self, stats):
+        """Append a batch of columns (as returned by _check_stats) to the history"""
+        with self._lock:
+            self._ids.extend(str(c_id) for c_id in stats['container_id'])
+            for col, values in self._columns.items():
+                values.frombytes(np.asarray(stats[col], dtype=np.float64).tobytes())
+            for c_id, t, cpu in zip(stats['container_id'], stats['time'], stats['cpu_norm']):
+                times, cpus = self._cpu.setdefault(str(c_id), (array('d'), array('d')))
+                times.append(t)
+                cpus.append(cpu)
+
     def _update(self):
-        """Run self._check_stats() and concatenate to self.history"""
-        self.history = pd.concat([self.history, self._check_stats()], ignore_index=True)
+        """Run self._check_stats() and append to the history"""
+        self._append(self._check_stats())
+
+    def cpu_mean(self, container_id, since):
+        """Mean normalized cpu usage of a container over the samples taken at or after `since`
+
+        :param container_id: the container ID
+        :param since: a unix timestamp
+        :return: the mean of cpu_norm, or None if there are no samples in the window
+        """
+        with self._lock:
+            times, cpus = self._cpu.get(container_id, (array('d'), array('d')))
+            window = np.array(cpus[bisect_left(times, since):], dtype=np.float64)
+        window = window[~np.isnan(window)]
+        if len(window) == 0:
+            return None
+        return window.mean()
+
+    def count_since(self, since):
+        """Number of stats samples recorded after `since`"""
+        with self._lock:
+            times = self._columns['time']
+            return len(times) - bisect_right(times, since)
+
+    def window(self, seconds):
+        """Return the samples recorded in the last `seconds` seconds as a JSON-serializable dict of columns"""
+        with self._lock:
+            start = bisect_left(self._columns['time'], time.time() - seconds)
+            data = {col: values[start:].tolist() for col, values in self._columns.items()}
+            data['container_id'] = self._ids[start:]
+        return data
+
+    def restore(self, window):
+        """Prepend a checkpointed metric window to the history
+
+        :param window: a dict of columns as returned by ResourceMonitor.window
+        :return: None
+        """
+        with self._lock:
+            ids, columns, self._ids, self._cpu = self._ids, self._columns, [], {}
+            self._columns = {col: array('d') for col in HISTORY_COLUMNS[1:]}
+        self._append(window)
+        self._append(dict(columns, container_id=ids))
+
+    @property
+    def history(self):
+        """The accumulated docker stats as a pd.DataFrame with columns HISTORY_COLUMNS, for export and analysis"""
+        import pandas as pd
+        with self._lock:
+            data = {col: np.array(values, dtype=np.float64) for col, values in self._columns.items()}
+            data['container_id'] = list(self._ids)
+        return pd.DataFrame(data, columns=HISTORY_COLUMNS)
 
     def kill(self):
         """Kill the RepeatedTimer thread"""
@@ -0,0 +1,128 @@
+"""Online loss-curve fitting to predict how much useful progress a job has left
+
+Algorithm 1 only sees the change in mean loss between two intervals, which is noisy. A LossCurveEstimator instead fits
+a decay curve to the whole loss history of a job, one point at a time, using running least-squares sums of log-loss:
+
+    exp:    L(t) = a * exp(-b * t)      (log L linear in t)
+    power:  L(t) = a * (t + 1) ** -b    (log L linear in log(t + 1))
+
+where t is the number of seconds since the first point. Each update is O(1) and the sums can be exponentially
+forgotten so that the fit tracks changes in the curve.
+
+A job is considered converged once its predicted progress rate, |dL/dt| / max loss, drops below `tolerance` (the
+same normalized units as the progress score of algorithm 1). The estimator predicts the time remaining until then and
+the normalized loss still to be shed, which the allocator can use to shift cpu towards jobs with the most left to gain.
+"""
+import math
+from bisect import bisect_right
+
+MODELS = ['exp', 'power']
+
+
+class LossCurveEstimator(object):
+    """Incremental fit of an exponential or power-law decay to one job's loss history"""
+
+    __slots__ = ('model', 'tolerance', 'forget', 't0', 'last_time', 'max_loss', 'last_loss',
+                 'n', 'sx', 'sy', 'sxx', 'sxy')
+
+    def __init__(self, model='exp', tolerance=1e-4, forget=1.):
+        """
+        :param model: one of MODELS
+        :param tolerance: normalized progress per second below which the job counts as converged
+        :param forget: weight kept by the existing sums at each update; 1 fits the whole history equally
+        """
+        if model not in MODELS:
+            raise ValueError("Unknown loss curve model {}, expected one of {}".format(model, MODELS))
+        self.model = model
+        self.tolerance = tolerance
+        self.forget = forget
+        self.t0 = None
+        self.last_time = None
+        self.max_loss = 0.
+        self.last_loss = None
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.
+
+    def _x(self, t):
+        return t if self.model == 'exp' else math.log(t + 1)
+
+    def update(self, timestamp, loss):
+        """Add one point of the loss history; points at or before the last one seen are ignored"""
+        if loss <= 0 or (self.last_time is not None and timestamp <= self.last_time):
+            return
+        if self.t0 is None:
+            self.t0 = timestamp
+        self.last_time = timestamp
+        self.last_loss = loss
+        self.max_loss = max(self.max_loss, loss)
+
+        x, y, f = self._x(timestamp - self.t0), math.log(loss), self.forget
+        self.n = f * self.n + 1
+        self.sx = f * self.sx + x
+        self.sy = f * self.sy + y
+        self.sxx = f * self.sxx + x * x
+        self.sxy = f * self.sxy + x * y
+
+    def update_many(self, timestamps, losses):
+        """Add the points of a time-ordered history that are newer than the last one seen
+
+        Old points are skipped with a binary search, so the cost is O(1) per new point.
+        """
+        start = 0 if self.last_time is None else bisect_right(timestamps, self.last_time)
+        for i in range(start, len(timestamps)):
+            self.update(timestamps[i], losses[i])
+
+    @property
+    def params(self):
+        """The fitted (a, b) of the decay curve, or None if there are too few points or the loss is not decaying"""
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 3 or denominator <= 1e-12:
+            return None
+        slope = (self.n * self.sxy - self.sx * self.sy) / denominator
+        intercept = (self.sy - slope * self.sx) / self.n
+        if slope >= 0:
+            return None
+        return math.exp(intercept), -slope
+
+    def predict(self, t):
+        """Predicted loss `t` seconds after the first point"""
+        a, b = self.params
+        return a * math.exp(-b * t) if self.model == 'exp' else a * (t + 1) ** -b
+
+    def _convergence_time(self):
+        """Seconds after the first point at which the predicted normalized progress rate equals the tolerance"""
+        a, b = self.params
+        scale = a * b / (self.max_loss * self.tolerance)
+        if scale <= 1:
+            return 0.
+        if self.model == 'exp':
+            return math.log(scale) / b
+        return scale ** (1 / (b + 1)) - 1
+
+    @property
+    def remaining_time(self):
+        """Predicted seconds until the job converges, 0 if it already has, None if there is no decaying fit"""
+        if self.params is None:
+            return None
+        return max(0., self._convergence_time() - (self.last_time - self.t0))
+
+    @property
+    def remaining_progress(self):
+        """Predicted drop in normalized loss (loss / max loss) before the job converges, None if there is no decaying
+        fit"""
+        if self.params is None:
+            return None
+        now = self.last_time - self.t0
+        converged = max(now, self._convergence_time())
+        return max(0., (self.predict(now) - self.predict(converged)) / self.max_loss)
+
+    def state(self):
+        """Return the running sums of self as a JSON-serializable dict, for checkpointing"""
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        """Inverse of LossCurveEstimator.state"""
+        estimator = cls(model=state['model'], tolerance=state['tolerance'], forget=state['forget'])
+        for attr in cls.__slots__:
+            setattr(estimator, attr, state[attr])
+        return estimator
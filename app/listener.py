@@ -1,5 +1,15 @@
 from app.threadutils import RepeatedTimer
 import subprocess
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+fh = logging.FileHandler('FlowCon.log')
+fh.setFormatter(formatter)
+logger.addHandler(fh)
 
 
 class TrialListener(object):
@@ -35,6 +45,103 @@ class TrialListener(object):
                     break
 
 
+class EventTrigger(object):
+
+    def __init__(self, trial, min_interval=5, max_interval=60, min_samples=1, poll_interval=None, max_log_checks=2):
+        """Run a Trial's algorithm when new progress data arrives instead of on a fixed interval
+
+        Every `poll_interval` seconds, once at least `min_interval` seconds have passed since the last run, the
+        algorithm is run if
+            a container has started or exited,
+            the containers have logged at least `min_samples` new loss records each (on average),
+            or the ResourceMonitor has recorded at least `min_samples` new rounds of docker stats,
+        and unconditionally once `max_interval` seconds have passed.
+
+        The first and last checks are one `docker ps` and a lookup in the monitor's history. Counting loss records
+        costs one `docker logs --since` process per container, so it is only done once those checks fail, and then
+        for at most `max_log_checks` containers per poll, round robin. Each container's count is kept until the next
+        run and later checks only read the logs since the container was last checked, so with many containers a
+        run on loss records may come a few polls late, but a poll never costs more than `max_log_checks` calls.
+
+        :param trial: the Trial whose run method is triggered
+        :param min_interval: minimum number of seconds between runs
+        :param max_interval: maximum number of seconds between runs
+        :param min_samples: number of new samples per container that triggers a run
+        :param poll_interval: seconds between checks for new data, defaults to min_interval / 2
+        :param max_log_checks: maximum number of containers whose logs are read per poll
+        """
+        self.trial = trial
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_samples = min_samples
+        self.poll_interval = poll_interval if poll_interval is not None else max(1, min_interval / 2)
+        self.max_log_checks = max_log_checks
+        self.last_run = time.time()
+        self._checked = {}     # container id -> time up to which its logs were counted
+        self._new_points = {}  # container id -> loss records counted since the last run
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self.timer = RepeatedTimer(self.poll_interval, self.poll)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def poll(self):
+        # Skip this poll if the previous run of the algorithm is still going
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            reason = self.reason()
+            if reason is not None:
+                logger.info("Triggering algorithm run: {}".format(reason))
+                self.last_run = time.time()
+                self._checked, self._new_points = {}, {}
+                self.trial.run(self.trial.containers, self.trial.monitor)
+        finally:
+            self._lock.release()
+
+    def reason(self):
+        """Return why the algorithm should run now, or None if it should not"""
+        elapsed = time.time() - self.last_run
+        if elapsed < self.min_interval:
+            return None
+        if elapsed >= self.max_interval:
+            return 'max interval of {}s elapsed'.format(self.max_interval)
+
+        containers = self.trial.containers
+        if set(get_active_containers()) != containers.ids:
+            return 'containers started or exited'
+
+        needed = self.min_samples * max(len(containers), 1)
+        new_stats = self.trial.monitor.count_since(self.last_run)
+        if new_stats >= needed:
+            return '{} new stats samples'.format(new_stats)
+
+        new_points = self.count_new_points(containers)
+        if new_points >= needed:
+            return '{} new loss records'.format(new_points)
+        return None
+
+    def count_new_points(self, containers):
+        """Count the loss records logged since the last run, reading the logs of at most `max_log_checks` containers
+
+        :param containers: the ContainerList
+        :return: int
+        """
+        ids = sorted(containers.ids)
+        for k in range(min(self.max_log_checks, len(ids))):
+            c = containers.get(ids[(self._next_check + k) % len(ids)])
+            now = time.time()
+            self._new_points[c.id] = self._new_points.get(c.id, 0) + \
+                c.count_new_points(self._checked.get(c.id, self.last_run))
+            self._checked[c.id] = now
+        self._next_check += self.max_log_checks
+        return sum(self._new_points.get(c_id, 0) for c_id in ids)
+
+
 def get_active_containers():
     """Return the number of currently running containers"""
     out = subprocess.check_output(['docker', 'ps', '-q'])
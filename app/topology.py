@@ -0,0 +1,285 @@
+"""Topology-aware cpuset placement
+
+`docker update --cpus` only sets a CFS quota, so a job's threads still migrate across every core of the host. In the
+cpuset enforcement modes the share each container gets from algorithm 1 is instead turned into a set of cores passed
+to `docker update --cpuset-cpus`. Cores are read from sysfs and ordered by NUMA node, socket and last-level cache so
+that each job's cores stay close together, and placements are repacked incrementally when limits change.
+
+    cpuset-exclusive: every core belongs to at most one container (the quota is dropped)
+    cpuset-shared: containers may share cores, and keep their quota so that shares are still enforced
+
+The sysfs root is a parameter so that a fake topology can be built in a temporary directory, e.g.
+    <root>/cpu/online                                    0-3
+    <root>/cpu/cpu<N>/topology/physical_package_id       0
+    <root>/cpu/cpu<N>/topology/core_id                   0
+    <root>/cpu/cpu<N>/cache/index<K>/{level,shared_cpu_list}
+    <root>/node/node<M>/cpulist                          0-1
+"""
+import os
+import glob
+import math
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+fh = logging.FileHandler('FlowCon.log')
+fh.setFormatter(formatter)
+logger.addHandler(fh)
+
+SYSFS_ROOT = '/sys/devices/system'
+ENFORCEMENT_MODES = ['quota', 'cpuset-exclusive', 'cpuset-shared']
+
+
+def parse_cpu_list(text):
+    """Parse a kernel cpu list such as '0-3,8,10-11' into a sorted list of ints"""
+    cpus = set()
+    for part in text.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    """Inverse of parse_cpu_list: format a collection of ints as '0-3,8,10-11'"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(lo) if lo == hi else '{}-{}'.format(lo, hi) for lo, hi in ranges)
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+class CpuTopology(object):
+    """The online cpus of a host and where each of them sits (NUMA node, socket, last-level cache)"""
+
+    def __init__(self, root=SYSFS_ROOT):
+        """
+        :param root: the sysfs directory containing `cpu/` and `node/`
+        """
+        cpu_dir = os.path.join(root, 'cpu')
+        online = _read(os.path.join(cpu_dir, 'online'))
+        if online is None:
+            online = ','.join(os.path.basename(p)[3:] for p in glob.glob(os.path.join(cpu_dir, 'cpu[0-9]*')))
+        self.cpus = parse_cpu_list(online)
+
+        node_of = {}
+        for node_dir in glob.glob(os.path.join(root, 'node', 'node[0-9]*')):
+            node = int(os.path.basename(node_dir)[4:])
+            for cpu in parse_cpu_list(_read(os.path.join(node_dir, 'cpulist'), '')):
+                node_of[cpu] = node
+
+        self.node = {}
+        self.package = {}
+        self.llc = {}
+        self.core = {}
+        for cpu in self.cpus:
+            base = os.path.join(cpu_dir, 'cpu{}'.format(cpu))
+            self.node[cpu] = node_of.get(cpu, 0)
+            self.package[cpu] = int(_read(os.path.join(base, 'topology', 'physical_package_id'), 0))
+            self.core[cpu] = int(_read(os.path.join(base, 'topology', 'core_id'), cpu))
+            self.llc[cpu] = self._last_level_cache(base, cpu)
+
+        # Walking the cpus in this order visits whole caches, then whole sockets, then whole nodes
+        self.order = sorted(self.cpus, key=lambda c: (self.node[c], self.package[c], self.llc[c], self.core[c], c))
+        self.rank = {cpu: i for i, cpu in enumerate(self.order)}
+        logger.info("Read topology of {} cpus, {} sockets, {} last-level caches from {}".format(
+            len(self.cpus), len(set(self.package.values())), len(set(self.llc.values())), root))
+
+    @staticmethod
+    def _last_level_cache(base, cpu):
+        """Identify the highest-level cache of `cpu` by the lowest cpu sharing it"""
+        best_level, best_id = -1, cpu
+        for index in glob.glob(os.path.join(base, 'cache', 'index[0-9]*')):
+            level = int(_read(os.path.join(index, 'level'), -1))
+            shared = parse_cpu_list(_read(os.path.join(index, 'shared_cpu_list'), str(cpu)))
+            if level > best_level and shared:
+                best_level, best_id = level, shared[0]
+        return best_id
+
+    def __len__(self):
+        return len(self.cpus)
+
+    def distance(self, a, b):
+        """0 if cpus a and b share a last-level cache, 1 if they share a socket or NUMA node, 2 otherwise"""
+        if self.llc[a] == self.llc[b]:
+            return 0
+        if self.package[a] == self.package[b] or self.node[a] == self.node[b]:
+            return 1
+        return 2
+
+
+def apportion(limits, total):
+    """Turn fractional cpu limits into whole core counts, at least 1 each, summing to at most `total`
+
+    Limits are rounded to the nearest core; if that oversubscribes the host the cores are split in proportion to the
+    limits with the largest remainder method. If there are at least as many containers as cores, each container gets
+    a single core (so with more containers than cores the sum is the number of containers, and cores are shared).
+
+    :param limits: a dict of id -> cpu limit
+    :param total: the number of cores available
+    :return: a dict of id -> number of cores
+    """
+    if len(limits) >= total:
+        if len(limits) > total:
+            logger.warning("{} containers for {} cores, pinning each container to a single shared core".format(
+                len(limits), total))
+        return {k: 1 for k in limits}
+
+    counts = {k: max(1, int(round(v))) for k, v in limits.items()}
+    if sum(counts.values()) <= total:
+        return counts
+
+    limit_sum = sum(limits.values())
+    quotas = {k: max(1., v * total / limit_sum) for k, v in limits.items()}
+    counts = {k: int(q) for k, q in quotas.items()}
+    remainder = sorted(limits, key=lambda k: quotas[k] - counts[k], reverse=True)
+    spare = total - sum(counts.values())
+    for k in remainder[:max(spare, 0)]:
+        counts[k] += 1
+    # Floors of one core can push the sum over; take back from the largest
+    while sum(counts.values()) > total:
+        k = max(counts, key=counts.get)
+        counts[k] -= 1
+    return counts
+
+
+class CpusetPlacer(object):
+    """Map each container's cpu limit onto a set of cores, keeping previous placements where possible
+
+    Each call to `place` first shrinks the jobs whose share went down, dropping their cores farthest from the rest of
+    the set, then grows the others with the least loaded cores closest to the ones they already hold. A new job is
+    started in the cache (or socket) with the tightest fit for its request.
+    """
+
+    def __init__(self, topology, exclusive=True):
+        """
+        :param topology: a CpuTopology
+        :param exclusive: if True, never give one core to two containers unless there are more containers than cores
+        """
+        self.topology = topology
+        self.exclusive = exclusive
+        self.assignment = {}
+
+    def place(self, limits):
+        """Compute cpusets for the given limits
+
+        :param limits: a dict of container id -> cpu limit in number of cpus
+        :return: a dict of container id -> sorted list of cpus
+        """
+        topo = self.topology
+        self.assignment = {k: v for k, v in self.assignment.items() if k in limits}
+        if self.exclusive:
+            counts = apportion(limits, len(topo))
+        else:
+            counts = {k: min(len(topo), max(1, int(math.ceil(v)))) for k, v in limits.items()}
+
+        load = Counter()
+        for cpus in self.assignment.values():
+            load.update(cpus)
+
+        for k, n in counts.items():
+            cpus = self.assignment.get(k, [])
+            if len(cpus) > n:
+                keep = sorted(cpus, key=lambda c: (self._spread(c, cpus), topo.rank[c]))[:n]
+                load.subtract(set(cpus) - set(keep))
+                self.assignment[k] = keep
+
+        # Grow jobs that already have cores before placing new ones, so that they can stay local
+        growing = sorted((k for k in counts if len(self.assignment.get(k, [])) < counts[k]),
+                         key=lambda k: (len(self.assignment.get(k, [])) == 0, -counts[k]))
+        for k in growing:
+            cpus = list(self.assignment.get(k, []))
+            need = counts[k] - len(cpus)
+            anchor = cpus[0] if cpus else self._best_fit(need, load)
+            held = set(cpus)
+            candidates = sorted((c for c in topo.order if c not in held),
+                                key=lambda c: (load[c], topo.distance(anchor, c), topo.rank[c]))
+            for c in candidates[:need]:
+                if self.exclusive and load[c] > 0:
+                    logger.warning("Not enough cores for exclusive placement, container {} shares cpu {}".format(k, c))
+                cpus.append(c)
+                load[c] += 1
+            self.assignment[k] = sorted(cpus)
+
+        return dict(self.assignment)
+
+    def adopt(self, container_id, cpus):
+        """Record an existing placement, e.g. one restored from a checkpoint"""
+        self.assignment[container_id] = sorted(cpus)
+
+    def _spread(self, cpu, cpus):
+        """Total topological distance from `cpu` to the other cpus of a set"""
+        return sum(self.topology.distance(cpu, other) for other in cpus)
+
+    def _best_fit(self, need, load):
+        """Pick a starting core for a new job: the smallest cache, then socket, whose free cores can hold `need`"""
+        topo = self.topology
+        free = [c for c in topo.order if load[c] <= 0]
+        if not free:
+            return min(topo.order, key=lambda c: (load[c], topo.rank[c]))
+        for group in (topo.llc, topo.package):
+            sizes = Counter(group[c] for c in free)
+            fits = [g for g, size in sizes.items() if size >= need]
+            if fits:
+                target = min(fits, key=lambda g: sizes[g])
+                return next(c for c in free if group[c] == target)
+        return free[0]
+
+    def apply(self, containers):
+        """Place every container in a ContainerList according to its cpu_lim and push the sets to docker
+
+        :param containers: the ContainerList
+        :return: None
+        """
+        self._adopt_all(containers)
+        limits = {c.id: c.cpu_lim for c in containers if c.cpu_lim is not None}
+        self._push(containers, self.place(limits))
+
+    def place_new(self, containers):
+        """Pin the containers that have no cpuset yet to a fair share of the cores, and push the sets to docker
+
+        Meant to be called right after the ContainerList is reconciled, so that new containers do not run unpinned
+        until the next run of algorithm 1. The containers already placed keep their number of cores, unless the host
+        has to be shared out again to fit the new ones.
+
+        :param containers: the ContainerList
+        :return: None
+        """
+        self._adopt_all(containers)
+        new = [c.id for c in containers if c.id not in self.assignment]
+        if not new:
+            return
+        share = len(self.topology) / len(containers)
+        limits = {c.id: len(self.assignment[c.id]) if c.id in self.assignment else share for c in containers}
+        logger.info("Placing {} new containers on {:.2f} cores each".format(len(new), share))
+        self._push(containers, self.place(limits))
+
+    def _adopt_all(self, containers):
+        for c in containers:
+            if c.id not in self.assignment and c.cpuset is not None:
+                self.adopt(c.id, parse_cpu_list(c.cpuset))
+
+    @staticmethod
+    def _push(containers, placement):
+        for c in containers:
+            if c.id not in placement:
+                continue
+            cpuset = format_cpu_list(placement[c.id])
+            if cpuset != c.cpuset:
+                c.cpuset = cpuset
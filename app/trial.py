@@ -11,14 +11,19 @@ to accumulate.
 
 import sys
 import os
+import csv
 import glob
+import time
 import shutil
 import zipfile
 import logging
-from app.listener import TrialListener
-
-from app.algorithm import *
-from app.threadutils import *
+from app.listener import TrialListener, EventTrigger
+from app.topology import CpuTopology, CpusetPlacer
+from app.checkpoint import checkpoint_path, write_checkpoint, read_checkpoint
+from app.dockerutils import ContainerList, ResourceMonitor
+from app.algorithm import algo_1, STATUS_COLUMNS, format_status, job_records, JOB_STATUS_COLUMNS
+from app.allocation import POLICIES
+from app.threadutils import RepeatedTimer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -40,15 +45,31 @@ class Trial(object):
     TODO Ideal case: each container has one monitor
     """
 
-    def __init__(self, alpha, name, interval, stats_interval, no_algo=False, no_update=False):
+    def __init__(self, alpha, name, interval, stats_interval, no_algo=False, no_update=False, resume=False,
+                 policy='multiplicative', enforcement='quota', event_driven=False, min_interval=5,
+                 max_interval=None, min_samples=1, max_log_checks=2, curve_model='exp'):
         """
         :param interval: the interval at which to run algorithm 1
         :param alpha: alpha for altorithm 1
         :param name: A name for the experiment Trial, passed as a command line arg.
         :param stats_interval: number of seconds between calls to docker stats: passed to ResourceMonitor
+        :param resume: if True, reload the checkpoint left by a previous controller for this Trial and reattach
+                       to its running containers instead of starting fresh
+        :param policy: the name of the allocation policy in app.allocation.POLICIES used by algorithm 1
+        :param enforcement: how limits are enforced, one of app.topology.ENFORCEMENT_MODES:
+                            'quota' uses `docker update --cpus`, the cpuset modes pin containers to sets of cores
+        :param event_driven: if True, run algorithm 1 when new loss or stats samples arrive or containers start or exit,
+                             rather than every `interval` seconds. `interval` is still the window growth is computed over,
+                             a container must stay watching for `interval` seconds before it is marked completing, and
+                             the multiplicative update is applied at most once per `interval`
+        :param min_interval: event-driven mode: minimum number of seconds between runs
+        :param max_interval: event-driven mode: maximum number of seconds between runs, defaults to `interval`
+        :param min_samples: event-driven mode: new samples per container needed to trigger a run
+        :param max_log_checks: event-driven mode: maximum number of containers whose logs are read per poll
+        :param curve_model: the decay model fitted to each job's loss history to predict its remaining progress
         """
 
-        if glob.glob('./experiment_{}*.zip'.format(name)):
+        if not resume and glob.glob('./experiment_{}*.zip'.format(name)):
             raise ValueError("Logs for an experiment with name '{}' already exist, ".format(name) +
                              "please use unique experiment names")
 
@@ -56,23 +77,49 @@ class Trial(object):
         self.alpha      = alpha
         self.name       = name
         self.monitor    = ResourceMonitor(stats_interval)
+        quota = enforcement != 'cpuset-exclusive'
         if no_algo or no_update:
-            self.containers = ContainerList(no_update=True)
+            self.containers = ContainerList(no_update=True, quota=quota, curve_model=curve_model)
+        else:
+            self.containers = ContainerList(no_update=False, quota=quota, curve_model=curve_model)
+        if enforcement == 'quota':
+            self.placer = None
         else:
-            self.containers = ContainerList(no_update=False)
-        self.status     = None
+            self.placer = CpusetPlacer(CpuTopology(), exclusive=enforcement == 'cpuset-exclusive')
+        self._status_fn = '{}_algo_1_iters.csv'.format(name)
+        self._job_status_fn = '{}_algo_1_jobs.csv'.format(name)
         self.interval = interval
         self.backoff_interval = interval  # for the exponential backoff
         self.stats_interval = stats_interval
         self.iter_num = 0
+        self.last_step = 0.  # when the limits were last updated, for the multiplicative policy in event-driven mode
         self.start_time = time.time()
         self._fn = 'watching_completing.csv'  # TODO put name here
         self.no_algo = no_algo
         self.no_update = no_update
+        self.policy = policy
+        self.enforcement = enforcement
+        self.event_driven = event_driven
+        self.min_interval = min_interval
         self.listener = TrialListener(self)
-        self.timer = RepeatedTimer(self.interval, self.run, self.containers, self.monitor)
+        self._checkpoint_fn = checkpoint_path(name)
+        if resume:
+            self.restore(read_checkpoint(self._checkpoint_fn))
+        else:
+            self._make_logfile()
+        if event_driven:
+            self.timer = EventTrigger(self, min_interval=min_interval,
+                                      max_interval=max_interval if max_interval is not None else interval,
+                                      min_samples=min_samples, max_log_checks=max_log_checks)
+            self._restart_timer(self.backoff_interval)
+        else:
+            self.timer = RepeatedTimer(self.backoff_interval, self.run, self.containers, self.monitor)
         self.timer.start()
-        self._make_logfile()
+        if resume:
+            self.containers.reconcile(experiment_name=self.name)
+            self._place_new()
+            if self.backoff_interval != self.interval:
+                self.listener.start()
 
         logger.info("Created Trial object with parameters name = {}, alpha = {}, interval = {}".format(name, alpha, interval))
 
@@ -80,21 +127,88 @@ class Trial(object):
         """Create a logfile for the Trial."""
         with open(self._fn, 'w') as f:
             f.write('iter, num_watching, num_completing, total\n')
+        for fn in (self._status_fn, self._job_status_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    @staticmethod
+    def _append_records(fn, columns, records):
+        """Append rows of records to a csv, writing the header first if the file is new"""
+        new = not os.path.exists(fn)
+        with open(fn, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(columns)
+            writer.writerows(record.values() for record in records)
+
+    def state(self):
+        """Return a JSON-serializable snapshot of the Trial, its containers and the recent resource history
+
+        The results of algorithm 1 are not part of the snapshot: they are appended to the algo_1 csvs as each
+        iteration produces them, so the snapshot stays the same size however long the trial runs.
+        """
+        return dict(
+            name=self.name,
+            alpha=self.alpha,
+            interval=self.interval,
+            backoff_interval=self.backoff_interval,
+            stats_interval=self.stats_interval,
+            iter_num=self.iter_num,
+            last_step=self.last_step,
+            start_time=self.start_time,
+            no_algo=self.no_algo,
+            no_update=self.no_update,
+            policy=self.policy,
+            enforcement=self.enforcement,
+            containers=self.containers.state(),
+            monitor_window=self.monitor.window(2 * self.interval),
+        )
+
+    def restore(self, state):
+        """Restore the Trial from a snapshot produced by Trial.state
+
+        :param state: the checkpoint dict
+        :return: None
+        """
+        logger.info("Resuming Trial {} from iteration {}".format(state['name'], state['iter_num']))
+        self.backoff_interval = state['backoff_interval']
+        self.iter_num = state['iter_num']
+        self.last_step = state['last_step']
+        self.start_time = state['start_time']
+        self.monitor.restore(state['monitor_window'])
+        self.containers.restore(state['containers'], self.name)
+
+    def checkpoint(self):
+        """Write a snapshot of the Trial to its checkpoint file"""
+        write_checkpoint(self._checkpoint_fn, self.state())
+
+    def _restart_timer(self, interval):
+        """Run the algorithm every `interval` seconds
+
+        In event-driven mode the trigger keeps polling, and its minimum interval is scaled by the same backoff factor
+        """
+        if self.event_driven:
+            self.timer.min_interval = min(self.min_interval * interval / self.interval, self.timer.max_interval)
+            return
+        self.timer.stop()
+        self.timer = RepeatedTimer(interval, self.run, self.containers, self.monitor)
+        self.timer.start()
+
+    def _place_new(self):
+        """In the cpuset enforcement modes, pin containers picked up by reconcile before algorithm 1 next runs"""
+        if self.placer is not None and not (self.no_algo or self.no_update) and len(self.containers) > 0:
+            self.placer.place_new(self.containers)
 
     def backoff(self):
         self.backoff_interval *= 2
         logger.info("Backing off algo interval to {}".format(self.backoff_interval))
-        self.timer.stop()
-        self.timer = RepeatedTimer(self.backoff_interval, self.run, self.containers, self.monitor)
-        self.timer.start()
+        self._restart_timer(self.backoff_interval)
         self.listener.start()
 
     def stop_backoff(self):
-        self.timer.stop()
         self.backoff_interval = self.interval
         logger.info("Resetting algo interval to {}".format(self.interval))
-        self.timer = RepeatedTimer(self.interval, self.run, self.containers, self.monitor)
-        self.timer.start()
+        self._restart_timer(self.interval)
         self.listener.stop()
 
     def run(self, containers, monitor):
@@ -104,55 +218,68 @@ class Trial(object):
         :param monitor: the DockerMonitor
         :return: None
 
-        This gets executed by self.timer every self.interval seconds
+        This gets executed by self.timer every self.interval seconds, or by an EventTrigger in event-driven mode
 
         In pseudocode:
 
             check for new containers and terminated containers:
                 update ContainerList and save logs accordingly
             run algorithm 1 over the ContainerList
-            append the results of algorithm1 to self.status
+            in the cpuset enforcement modes, repack the containers' cpusets from their new limits
+            append the results of algorithm1 to <name>_algo_1_iters.csv, and the per-job results to <name>_algo_1_jobs.csv
             write the cardinality of containers in (watching, completing, and total) to the appropriate log
-            update ContainerList
+            update ContainerList, and in the cpuset enforcement modes pin new containers to a fair share of the cores
             if ContainerList is empty:
                 save all logs
                 zip all logs
                 exit
+            write a checkpoint of the Trial state
         """
         logger.debug("Executing Trial.run()")
         containers.reconcile(experiment_name=self.name)
         if not self.no_algo and len(containers) > 0:
-            status = algo_1(containers, monitor, alpha=self.alpha, interval=self.interval, no_update=self.no_update)
+            # The multiplicative update compounds, so between runs closer than `interval` the limits are left alone
+            hold = self.event_driven and self.policy == 'multiplicative' and \
+                time.time() - self.last_step < self.interval
+            status = algo_1(containers, monitor, alpha=self.alpha, interval=self.interval,
+                            no_update=self.no_update or hold, policy=POLICIES[self.policy],
+                            min_watch=self.interval if self.event_driven else 0)
+            if not hold:
+                self.last_step = time.time()
+            if self.placer is not None and not self.no_update:
+                self.placer.apply(containers)
 
             if self.containers.all_completing:
                 self.backoff()
 
             delta_t = round(time.time() - self.start_time, 2)
-            status.insert(1, 'delta_t', delta_t)
-            status.insert(2, 'iter', self.iter_num)
+            jobs = job_records(containers, status[0].time if status else time.time())
+            for record in status + jobs:
+                record.delta_t = delta_t
+                record.iter = self.iter_num
             self.iter_num += 1
 
-            if self.status is None:
-                self.status = status
-            else:
-                self.status = pd.concat([self.status, status])
+            self._append_records(self._status_fn, STATUS_COLUMNS, status)
+            self._append_records(self._job_status_fn, JOB_STATUS_COLUMNS, jobs)
 
-            print(status)
+            print(format_status(status))
 
             with open(self._fn, 'a') as f:
                 f.write('{}, {}, {}, {}\n'.format(self.iter_num, self.containers.num_watching,
                                                   self.containers.num_completing, len(self.containers)))
 
         containers.reconcile(experiment_name=self.name)
+        self._place_new()
 
         if len(containers) == 0:
             self.kill()
 
+        self.checkpoint()
+
 
     def to_csv(self):
+        """Write the resource monitor history; the algo_1 records are already on disk"""
         logger.debug("Writing Trial records to CSV")
-        if not self.no_algo:
-            self.status.to_csv('{}_algo_1_iters.csv'.format(self.name), index=False)
         self.monitor.to_csv(self.name)
 
     def kill(self):
@@ -1,9 +1,18 @@
 """The main point of entry for this program"""
 
+import csv
+import time
 import argparse
 import logging
+import subprocess
+from subprocess import DEVNULL
+from collections import defaultdict
 
-from app.trial import *
+from app.trial import Trial
+from app.allocation import POLICIES
+from app.topology import ENFORCEMENT_MODES
+from app.admission import AdmissionController, ORDERINGS
+from app.estimator import MODELS
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -13,18 +22,62 @@ fh.setFormatter(formatter)
 logger.addHandler(fh)
 
 
-def run_job_list(job_list):
-    """"""
-    jobs = pd.read_csv(job_list)
-    stop = jobs.seconds.max()
+def launch_progress_path(name):
+    """The file recording the last second of the schedule whose jobs were launched"""
+    return '{}_launched'.format(name)
 
-    for i in range(stop+1):
-        jobs_i = jobs[jobs.seconds == i]
-        # print('i:', i, '\njobs_i:\n', jobs_i)
-        if jobs_i.shape[0] > 0:
-            for job in jobs_i.images:
-                subprocess.Popen(['docker', 'run', job], stdout=DEVNULL)
-                logger.info('Launching container with `docker run {}`'.format(job))
+
+def read_launch_progress(name):
+    """Return the second of the schedule to resume launching from, 0 if nothing was launched yet"""
+    try:
+        with open(launch_progress_path(name)) as f:
+            return int(f.read().strip()) + 1
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def run_job_list(job_list, start_time, name, start=0, admission=None):
+    """Launch the jobs in `job_list` at their scheduled second
+
+    After the jobs of each second are launched (or queued) the second is written to `<name>_launched`, so that a
+    resumed trial can carry on with the first job that was not started. Jobs whose second has already passed are
+    launched straight away.
+
+    :param job_list: a csv of jobs produced by make_joblist.py
+    :param start_time: the time at which second 0 of the schedule started
+    :param name: the name of the trial, used for the progress file
+    :param start: the second of the schedule to start from; jobs scheduled before it are assumed to be launched already
+    :param admission: an AdmissionController; if given, jobs are queued at their scheduled second and launched when
+                      admitted, and this returns once the queue is empty. The queue is saved before the second is
+                      recorded, so a crash in between never loses the second's jobs
+    """
+    jobs = defaultdict(list)
+    with open(job_list, newline='') as f:
+        for row in csv.DictReader(f):
+            jobs[int(row['seconds'])].append(row['images'])
+    stop = max(jobs) if jobs else -1
+
+    for i in range(start, stop+1):
+        delay = start_time + i - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        jobs_i = jobs.get(i, [])
+        if len(jobs_i) > 0:
+            if delay < -1:
+                logger.info('Launching {} jobs scheduled at second {}, {:.0f}s late'.format(len(jobs_i), i, -delay))
+            if admission is not None:
+                admission.submit(jobs_i, i)
+            else:
+                for job in jobs_i:
+                    subprocess.Popen(['docker', 'run', job], stdout=DEVNULL)
+                    logger.info('Launching container with `docker run {}`'.format(job))
+            with open(launch_progress_path(name), 'w') as f:
+                f.write(str(i))
+        if admission is not None:
+            admission.admit()
+
+    while admission is not None and admission.pending > 0:
+        admission.admit()
         time.sleep(1)
 
 if __name__ == '__main__':
@@ -37,11 +90,35 @@ if __name__ == '__main__':
                         help='Rate at which to change resource allocation')
     parser.add_argument("--docker_stats_interval", type=int, default=30,
                         help="Number of seconds between calls to `docker stats`")
+    parser.add_argument('-p', '--policy', choices=sorted(POLICIES), default='multiplicative',
+                        help='The allocation policy used to set cpu limits from growth efficiency')
+    parser.add_argument('-e', '--enforcement', choices=ENFORCEMENT_MODES, default='quota',
+                        help='Enforce limits with a cpu quota or by pinning containers to exclusive or shared cpusets')
+    parser.add_argument('--event_driven', action='store_true',
+                        help='Run algorithm 1 when new progress data arrives rather than every INTERVAL seconds')
+    parser.add_argument('--min_interval', type=int, default=5,
+                        help='With --event_driven, the minimum number of seconds between runs of algorithm 1')
+    parser.add_argument('--max_interval', type=int, default=None,
+                        help='With --event_driven, the maximum number of seconds between runs (default: INTERVAL)')
+    parser.add_argument('--min_samples', type=int, default=1,
+                        help='With --event_driven, the number of new samples per container that triggers a run')
+    parser.add_argument('--max_log_checks', type=int, default=2,
+                        help='With --event_driven, the maximum number of containers whose logs are read per poll')
+    parser.add_argument('--admission', choices=ORDERINGS, default=None,
+                        help='Queue jobs while the host is at capacity, admitting them in this order')
+    parser.add_argument('--default_demand', type=float, default=1.,
+                        help='With --admission, the cores assumed for a job without stats yet')
+    parser.add_argument('--overcommit', type=float, default=1.,
+                        help='With --admission, admit jobs up to OVERCOMMIT times the number of cpus')
+    parser.add_argument('--curve_model', choices=MODELS, default='exp',
+                        help='The decay curve fitted online to each loss history to predict remaining progress')
     control = parser.add_mutually_exclusive_group()
     control.add_argument('--no_update', action='store_true',
                          help='Run the algorithm but do not update any container limits')
     control.add_argument('--no_algo', action='store_true',
                          help='Do not run the algorithm')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume a crashed trial with the same arguments from its checkpoint')
 
     args = parser.parse_args()
     for arg, val in vars(args).items():
@@ -51,9 +128,28 @@ if __name__ == '__main__':
     session_name = "no_algo" if args.no_algo \
                    else "no_update" if args.no_update \
                    else "a{}_i{}".format(args.alpha, args.interval)
+    if not args.no_algo and args.policy != 'multiplicative':
+        session_name += "_{}".format(args.policy)
+    if not args.no_algo and args.enforcement != 'quota':
+        session_name += "_{}".format(args.enforcement)
+    if not args.no_algo and args.event_driven:
+        session_name += "_event"
+    if args.admission is not None:
+        session_name += "_adm{}".format(args.admission)
 
     logger.info(
         "Running trial with arguments a = {}, i = {}, name = {}".format(args.alpha, args.interval, session_name))
     session = Trial(interval=args.interval, name=session_name, alpha=args.alpha, no_algo=args.no_algo,
-                    no_update=args.no_update, stats_interval=args.docker_stats_interval)
-    run_job_list(args.joblist)
+                    no_update=args.no_update, stats_interval=args.docker_stats_interval, resume=args.resume,
+                    policy=args.policy, enforcement=args.enforcement, event_driven=args.event_driven,
+                    min_interval=args.min_interval, max_interval=args.max_interval, min_samples=args.min_samples,
+                    max_log_checks=args.max_log_checks, curve_model=args.curve_model)
+    admission = None if args.admission is None else \
+        AdmissionController(session, order=args.admission, default_demand=args.default_demand,
+                            overcommit=args.overcommit, resume=args.resume)
+    start = 0
+    if args.resume:
+        start = read_launch_progress(session_name)
+        if admission is not None:
+            start = max(start, admission.submitted + 1)
+    run_job_list(args.joblist, session.start_time, session_name, start=start, admission=admission)